@@ -1,24 +1,111 @@
 # Copyright (c) OpenMMLab. All rights reserved.
+from collections import OrderedDict
+from contextlib import nullcontext
 from typing import List, Union
 
 import torch
 import torch.nn.functional as F
+from mmengine.logging import MessageHub
+from mmengine.runner.amp import autocast
 from torch import Tensor
 
 # 导入所需的模块和类
 from mmdet.registry import MODELS
 from mmdet.structures import SampleList
-from mmdet.utils import InstanceList, OptInstanceList, reduce_mean
+from mmdet.utils import (InstanceList, OptConfigType, OptInstanceList,
+                         reduce_mean)
 
 # 导入其他模块中的函数和类
 from ..utils import multi_apply, unpack_gt_instances
 from .crosskd_single_stage import CrossKDSingleStageDetector
 
 
+@torch.jit.script
+def _align_scale(stu_feat: Tensor, tea_feat: Tensor) -> Tensor:
+    """Align the per-channel statistics of ``stu_feat`` to ``tea_feat``.
+
+    The student feature is normalized per channel over the (N, H, W) dims by
+    a parameter-free ``F.batch_norm``, which computes the statistics and
+    the normalization in a single native batch-norm kernel. ``eps=1e-12``
+    is below cuDNN's minimum, so the cuDNN path is not taken. The teacher
+    mean and std are then applied in a single elementwise expression.
+
+    Both sides use the biased (population) variance, as ``F.batch_norm``
+    does. The original formulation used the unbiased std on both sides;
+    since the ``sqrt(n / (n - 1))`` factor cancels in the ratio of the
+    teacher and student std, the result only differs by the epsilon term.
+
+    ``F.batch_norm`` rejects a single value per channel (N * H * W == 1,
+    e.g. batch size 1 on a 1x1 level), so that case normalizes with
+    ``torch.var_mean`` instead. The student then has zero variance and the
+    output is the teacher mean, where the unbiased formulation gave NaN.
+    """
+    if stu_feat.numel() == stu_feat.size(1):
+        stu_var, stu_mean = torch.var_mean(
+            stu_feat, dim=[0, 2, 3], unbiased=False, keepdim=True)
+        stu_feat = (stu_feat - stu_mean) * torch.rsqrt(stu_var + 1e-12)
+    else:
+        stu_feat = F.batch_norm(
+            stu_feat, None, None, None, None, training=True, eps=1e-12)
+    tea_var, tea_mean = torch.var_mean(
+        tea_feat, dim=[0, 2, 3], unbiased=False, keepdim=True)
+    return stu_feat * tea_var.sqrt() + tea_mean
+
+
+@torch.jit.script
+def _align_scale_with_stats(stu_feat: Tensor, stu_mean: Tensor,
+                            stu_var: Tensor, tea_feat: Tensor) -> Tensor:
+    """Same as :func:`_align_scale`, but with given biased student
+    statistics. The teacher statistics are always computed from
+    ``tea_feat``."""
+    tea_var, tea_mean = torch.var_mean(
+        tea_feat, dim=[0, 2, 3], unbiased=False, keepdim=True)
+    return (stu_feat - stu_mean) * torch.rsqrt(stu_var + 1e-12) * \
+        tea_var.sqrt() + tea_mean
+
+
 # 注册当前模型为MMDetection的模型组件
 @MODELS.register_module()
 class CrossKDGFL(CrossKDSingleStageDetector):
 
+    def __init__(self, kd_cfg: OptConfigType = None, **kwargs) -> None:
+        super().__init__(kd_cfg=kd_cfg, **kwargs)
+        for head in (self.bbox_head, self.teacher.bbox_head):
+            assert 0 <= self.reused_teacher_head_idx <= head.stacked_convs, \
+                '`reused_teacher_head_idx` should be in the range ' \
+                f'[0, {head.stacked_convs}], but got ' \
+                f'{self.reused_teacher_head_idx}'
+        # 教师前向的自动混合精度类型，例如 'bfloat16' 或 'float16'，
+        # 为 None 时教师以 FP32 运行
+        self.teacher_amp_dtype = kd_cfg.get('teacher_amp_dtype', None)
+        # 可选地在学生特征统计量变化很小时复用上一次的学生方差，例如
+        # align_cache_cfg=dict(thr=0.05, start_iter=10000, interval=1000)。
+        # 相邻批次间学生均值的相对漂移通常远大于1e-3，thr需按模型调整；
+        # 每次判断都有一次主机同步，interval默认为1000。
+        # 这会改变训练语义，默认关闭
+        self.align_cache_cfg = kd_cfg.get('align_cache_cfg', None)
+        self._align_stats_cache = {}
+        self._align_stu_means = {}
+        self._align_cache_hit = None
+        self._align_cache_refresh = False
+        # 按特征图尺寸缓存多尺度锚点，最多保留8组
+        self._anchor_cache = OrderedDict()
+        self._anchor_cache_size = 8
+        # 可选地用 torch.compile 编译逐级别的头部前向，例如
+        # compile_cfg=dict(dynamic=True)。头部在多个CUDA流上运行，
+        # 不要使用基于CUDA Graph的 mode='reduce-overhead'。
+        # reuse_teacher_head 会写入对齐统计量缓存，开启 align_cache_cfg
+        # 时不编译该函数
+        compile_cfg = kd_cfg.get('compile_cfg', None)
+        if compile_cfg is not None:
+            assert hasattr(torch, 'compile'), \
+                '`compile_cfg` requires PyTorch >= 2.0'
+            self.forward_crosskd_single = torch.compile(
+                self.forward_crosskd_single, **compile_cfg)
+            if self.align_cache_cfg is None:
+                self.reuse_teacher_head = torch.compile(
+                    self.reuse_teacher_head, **compile_cfg)
+
     def loss(self, batch_inputs: Tensor,
              batch_data_samples: SampleList) -> Union[dict, list]:
         """Calculate losses from a batch of inputs and data samples.
@@ -37,11 +124,35 @@ class CrossKDGFL(CrossKDSingleStageDetector):
             dict: A dictionary of loss components.
             损失组件的字典。
         """
+        # 教师与学生的前向相互独立，在GPU上将教师分支放入单独的CUDA流，
+        # 与学生分支并行执行。教师参数冻结，不需要记录反向图。
+        # 这里使用 no_grad 而不是 inference_mode：教师的输出会作为
+        # align_scale 和蒸馏损失的输入被保存用于反向传播，
+        # inference_mode 产生的张量不允许参与 autograd
+        tea_stream = self._get_teacher_stream(batch_inputs)
+        # batch_inputs 已由 data_preprocessor 归一化一次，教师与学生共用
+        if tea_stream is not None:
+            tea_stream.wait_stream(torch.cuda.current_stream())
+            # 告知缓存分配器 batch_inputs 也在教师流上使用，
+            # 防止其显存在教师分支完成前被回收复用
+            batch_inputs.record_stream(tea_stream)
+            stream_ctx = torch.cuda.stream(tea_stream)
+        else:
+            stream_ctx = nullcontext()
+
         # 提取教师模型的特征和预测
-        tea_x = self.teacher.extract_feat(batch_inputs)
-        tea_cls_scores, tea_bbox_preds, tea_cls_hold, tea_reg_hold = \
-            multi_apply(self.forward_crosskd_single, tea_x,
-                        self.teacher.bbox_head.scales, module=self.teacher)
+        if self.teacher_amp_dtype is not None:
+            amp_ctx = autocast(
+                device_type=batch_inputs.device.type,
+                dtype=getattr(torch, self.teacher_amp_dtype))
+        else:
+            amp_ctx = nullcontext()
+        with stream_ctx, torch.no_grad(), amp_ctx:
+            tea_x = self.teacher.extract_feat(batch_inputs)
+            tea_cls_scores, tea_bbox_preds, tea_cls_hold, tea_reg_hold = \
+                multi_apply(self.forward_crosskd_single, tea_x,
+                            self.teacher.bbox_head.scales,
+                            module=self.teacher)
 
         # 提取学生模型的特征和预测
         stu_x = self.extract_feat(batch_inputs)
@@ -49,10 +160,13 @@ class CrossKDGFL(CrossKDSingleStageDetector):
             multi_apply(self.forward_crosskd_single, stu_x,
                         self.bbox_head.scales, module=self)
 
+        # 等待教师分支完成后再使用其输出
+        if tea_stream is not None:
+            torch.cuda.current_stream().wait_stream(tea_stream)
+
         # 重用教师模型的头部进行预测
-        reused_cls_scores, reused_bbox_preds = multi_apply(
-            self.reuse_teacher_head, tea_cls_hold, tea_reg_hold, stu_cls_hold,
-            stu_reg_hold, self.teacher.bbox_head.scales)
+        reused_cls_scores, reused_bbox_preds = self.reuse_teacher_head_levels(
+            tea_cls_hold, tea_reg_hold, stu_cls_hold, stu_reg_hold)
 
         # 解包批量数据样本
         outputs = unpack_gt_instances(batch_data_samples)
@@ -67,29 +181,133 @@ class CrossKDGFL(CrossKDSingleStageDetector):
                                    batch_gt_instances_ignore)
         return losses
 
+    def _get_teacher_stream(self, batch_inputs: Tensor):
+        """Get the side CUDA stream used by the teacher branch.
+
+        The stream is created lazily and reused across iterations. Returns
+        None when the inputs are not on a CUDA device.
+        """
+        if not batch_inputs.is_cuda:
+            return None
+        stream = getattr(self, '_teacher_stream', None)
+        if stream is None or stream.device != batch_inputs.device:
+            stream = torch.cuda.Stream(device=batch_inputs.device)
+            self._teacher_stream = stream
+        return stream
+
+    def _get_level_streams(self, feat: Tensor, num_levels: int):
+        """Get the side CUDA streams used by the per-level reused teacher
+        heads.
+
+        The streams are created lazily and reused across iterations. Returns
+        None when the features are not on a CUDA device.
+        """
+        if not feat.is_cuda:
+            return None
+        streams = getattr(self, '_level_streams', None)
+        if streams is None or len(streams) != num_levels or \
+                streams[0].device != feat.device:
+            streams = [
+                torch.cuda.Stream(device=feat.device)
+                for _ in range(num_levels)
+            ]
+            self._level_streams = streams
+        return streams
+
+    def reuse_teacher_head_levels(self, tea_cls_hold, tea_reg_hold,
+                                  stu_cls_hold, stu_reg_hold):
+        """Run :meth:`reuse_teacher_head` on all FPN levels.
+
+        The levels are independent, so on GPU each one is issued on its own
+        CUDA stream. The small top levels can then overlap with the larger
+        ones instead of leaving the device underutilized.
+        """
+        num_levels = len(tea_cls_hold)
+        scales = self.teacher.bbox_head.scales
+        self._update_align_cache_state(stu_cls_hold, stu_reg_hold)
+        streams = self._get_level_streams(stu_cls_hold[0], num_levels)
+        if streams is None:
+            return multi_apply(self.reuse_teacher_head, tea_cls_hold,
+                               tea_reg_hold, stu_cls_hold, stu_reg_hold,
+                               scales, range(num_levels))
+
+        cur_stream = torch.cuda.current_stream()
+        reused_cls_scores, reused_bbox_preds = [], []
+        for level, stream in enumerate(streams):
+            stream.wait_stream(cur_stream)
+            level_inputs = (tea_cls_hold[level], tea_reg_hold[level],
+                            stu_cls_hold[level], stu_reg_hold[level])
+            # 输入在其他流上分配，需告知缓存分配器它们也在该流上使用
+            for feat in level_inputs:
+                feat.record_stream(stream)
+            with torch.cuda.stream(stream):
+                reused_cls_score, reused_bbox_pred = self.reuse_teacher_head(
+                    *level_inputs, scales[level], level)
+            reused_cls_scores.append(reused_cls_score)
+            reused_bbox_preds.append(reused_bbox_pred)
+        for stream in streams:
+            cur_stream.wait_stream(stream)
+        return reused_cls_scores, reused_bbox_preds
+
     def forward_crosskd_single(self, x, scale, module):
+        """Forward the head of ``module`` on a single FPN level.
+
+        Levels are processed one by one through ``multi_apply``: the head
+        convs use GroupNorm, whose statistics depend on the spatial extent
+        of each level, so padding and stacking levels into one batch (e.g.
+        for ``torch.vmap``) would change the outputs.
+
+        Returns:
+            tuple[Tensor]: cls_score, bbox_pred and the pre-activation cls /
+            reg features after the ``reused_teacher_head_idx``-th conv.
+        """
         # 提取分类和回归特征
-        cls_feat, reg_feat = x, x
-        cls_feat_hold, reg_feat_hold = x, x
-        for i, cls_conv in enumerate(module.bbox_head.cls_convs):
-            cls_feat = cls_conv(cls_feat, activate=False)
-            if i + 1 == self.reused_teacher_head_idx:
-                cls_feat_hold = cls_feat
-            cls_feat = cls_conv.activate(cls_feat)
-        for i, reg_conv in enumerate(module.bbox_head.reg_convs):
-            reg_feat = reg_conv(reg_feat, activate=False)
-            if i + 1 == self.reused_teacher_head_idx:
-                reg_feat_hold = reg_feat
-            reg_feat = reg_conv.activate(reg_feat)
+        cls_feat, cls_feat_hold = self.forward_stacked_convs(
+            x, module.bbox_head.cls_convs)
+        reg_feat, reg_feat_hold = self.forward_stacked_convs(
+            x, module.bbox_head.reg_convs)
         cls_score = module.bbox_head.gfl_cls(cls_feat)
         bbox_pred = scale(module.bbox_head.gfl_reg(reg_feat)).float()
         return cls_score, bbox_pred, cls_feat_hold, reg_feat_hold
 
-    def reuse_teacher_head(self, tea_cls_feat, tea_reg_feat, stu_cls_feat,
-                           stu_reg_feat, scale):
+    def forward_stacked_convs(self, x, convs):
+        """Forward a stack of head convs.
+
+        Only the ``reused_teacher_head_idx``-th conv is split into conv and
+        activation to keep its pre-activation output; the others run as a
+        single ``ConvModule`` call.
+
+        Returns:
+            tuple[Tensor]: The output of the stack and the held
+            pre-activation feature.
+        """
+        idx = self.reused_teacher_head_idx
+        feat_hold = x
+        if idx > 0:
+            for i in range(idx - 1):
+                x = convs[i](x)
+            x = convs[idx - 1](x, activate=False)
+            feat_hold = x
+            x = convs[idx - 1].activate(x)
+        for i in range(idx, len(convs)):
+            x = convs[i](x)
+        return x, feat_hold
+
+    def reuse_teacher_head(self,
+                           tea_cls_feat,
+                           tea_reg_feat,
+                           stu_cls_feat,
+                           stu_reg_feat,
+                           scale,
+                           level=None):
         # 对齐特征
-        reused_cls_feat = self.align_scale(stu_cls_feat, tea_cls_feat)
-        reused_reg_feat = self.align_scale(stu_reg_feat, tea_reg_feat)
+        cls_key, reg_key = None, None
+        if level is not None:
+            cls_key, reg_key = (level, 'cls'), (level, 'reg')
+        reused_cls_feat = self.align_scale(
+            stu_cls_feat, tea_cls_feat, cache_key=cls_key)
+        reused_reg_feat = self.align_scale(
+            stu_reg_feat, tea_reg_feat, cache_key=reg_key)
         if self.reused_teacher_head_idx != 0:
             reused_cls_feat = F.relu(reused_cls_feat)
             reused_reg_feat = F.relu(reused_reg_feat)
@@ -103,20 +321,97 @@ class CrossKDGFL(CrossKDSingleStageDetector):
         reused_bbox_pred = scale(module.gfl_reg(reused_reg_feat)).float()
         return reused_cls_score, reused_bbox_pred
 
-    def align_scale(self, stu_feat, tea_feat):
-        # 归一化学生特征
-        N, C, H, W = stu_feat.size()
-        stu_feat = stu_feat.permute(1, 0, 2, 3).reshape(C, -1)
-        stu_mean = stu_feat.mean(dim=-1, keepdim=True)
-        stu_std = stu_feat.std(dim=-1, keepdim=True)
-        stu_feat = (stu_feat - stu_mean) / (stu_std + 1e-6)
-
-        # 对齐尺度并反归一化
-        tea_feat = tea_feat.permute(1, 0, 2, 3).reshape(C, -1)
-        tea_mean = tea_feat.mean(dim=-1, keepdim=True)
-        tea_std = tea_feat.std(dim=-1, keepdim=True)
-        stu_feat = stu_feat * tea_std + tea_mean
-        return stu_feat.reshape(C, N, H, W).permute(1, 0, 2, 3)
+    def _update_align_cache_state(self, stu_cls_hold, stu_reg_hold):
+        """Decide once per iteration whether :meth:`align_scale` reuses the
+        cached statistics.
+
+        The relative drifts of all student means are stacked and compared
+        with the threshold through a single host sync, and only every
+        ``interval`` iterations (1000 by default); the last decision is kept
+        in between. When the cache is missed, the student statistics are
+        refreshed in :meth:`align_scale`. Only the student statistics are
+        cached, the teacher ones always come from the current batch.
+        """
+        self._align_stu_means = {}
+        self._align_cache_refresh = False
+        cfg = self.align_cache_cfg
+        cur_iter = MessageHub.get_current_instance().get_info('iter')
+        start_iter = 0 if cfg is None else cfg.get('start_iter', 0)
+        if cfg is None or cur_iter is None or cur_iter < start_iter:
+            self._align_cache_hit = None
+            return
+
+        keys = [(level, branch) for level in range(len(stu_cls_hold))
+                for branch in ('cls', 'reg')]
+        if any(key not in self._align_stats_cache for key in keys):
+            self._align_cache_hit = False
+            self._align_cache_refresh = True
+            return
+        if self._align_cache_hit is not None and \
+                (cur_iter - start_iter) % cfg.get('interval', 1000) != 0:
+            return
+
+        drifts = []
+        for level, (cls_feat, reg_feat) in enumerate(
+                zip(stu_cls_hold, stu_reg_hold)):
+            for branch, feat in (('cls', cls_feat), ('reg', reg_feat)):
+                stu_mean = feat.mean(dim=(0, 2, 3), keepdim=True)
+                prev_mean = self._align_stats_cache[(level, branch)][0]
+                self._align_stu_means[(level, branch)] = stu_mean
+                drifts.append((stu_mean.detach() - prev_mean).abs().sum() /
+                              prev_mean.abs().sum().clamp(min=1e-12))
+        self._align_cache_hit = bool(
+            torch.stack(drifts).max().item() < cfg.get('thr', 1e-3))
+        self._align_cache_refresh = not self._align_cache_hit
+
+    def align_scale(self, stu_feat, tea_feat, cache_key=None):
+        # 将学生特征按通道归一化后对齐到教师特征的均值和标准差，
+        # 教师特征可能是半精度的，统计量在FP32下计算
+        tea_feat = tea_feat.float()
+        if cache_key is None or not self._align_cache_hit:
+            # 未命中时与默认路径一致，并按需刷新缓存的统计量
+            if cache_key is not None and self._align_cache_refresh:
+                with torch.no_grad():
+                    stu_var, stu_mean = torch.var_mean(
+                        stu_feat, dim=(0, 2, 3), unbiased=False, keepdim=True)
+                self._align_stats_cache[cache_key] = (stu_mean, stu_var)
+            return _align_scale(stu_feat, tea_feat)
+
+        # 命中时复用缓存的学生方差，学生均值和教师统计量仍按当前批次计算
+        _, stu_var = self._align_stats_cache[cache_key]
+        stu_mean = self._align_stu_means.get(cache_key)
+        if stu_mean is None:
+            stu_mean = stu_feat.mean(dim=(0, 2, 3), keepdim=True)
+        return _align_scale_with_stats(stu_feat, stu_mean, stu_var, tea_feat)
+
+    def get_cached_anchors(self, featmap_sizes, batch_img_metas, device):
+        """Get anchors and valid flags, with the multi-level anchors cached by
+        the feature map sizes.
+
+        The anchors only depend on the feature map sizes, so they are reused
+        across iterations. The valid flags depend on the ``pad_shape`` of
+        each image and are cheap, so they are still computed per batch. Each
+        image gets its own copy of the cached list because ``get_targets``
+        replaces the items of ``anchor_list`` in place.
+        """
+        key = (tuple(tuple(size) for size in featmap_sizes), str(device))
+        if key in self._anchor_cache:
+            self._anchor_cache.move_to_end(key)
+            multi_level_anchors = self._anchor_cache[key]
+        else:
+            multi_level_anchors = self.bbox_head.prior_generator.grid_priors(
+                featmap_sizes, device=device)
+            self._anchor_cache[key] = multi_level_anchors
+            if len(self._anchor_cache) > self._anchor_cache_size:
+                self._anchor_cache.popitem(last=False)
+        anchor_list = [list(multi_level_anchors) for _ in batch_img_metas]
+
+        valid_flag_list = []
+        for img_meta in batch_img_metas:
+            multi_level_flags = self.bbox_head.prior_generator.valid_flags(
+                featmap_sizes, img_meta['pad_shape'], device)
+            valid_flag_list.append(multi_level_flags)
+        return anchor_list, valid_flag_list
 
     def loss_by_feat(
             self,
@@ -167,7 +462,7 @@ class CrossKDGFL(CrossKDSingleStageDetector):
         assert len(featmap_sizes) == self.bbox_head.prior_generator.num_levels
 
         device = cls_scores[0].device
-        anchor_list, valid_flag_list = self.bbox_head.get_anchors(
+        anchor_list, valid_flag_list = self.get_cached_anchors(
             featmap_sizes, batch_img_metas, device=device)
 
         # 获取分类和回归的目标
@@ -181,8 +476,15 @@ class CrossKDGFL(CrossKDSingleStageDetector):
         (anchor_list, labels_list, label_weights_list, bbox_targets_list,
          bbox_weights_list, avg_factor) = cls_reg_targets
 
-        avg_factor = reduce_mean(
-            torch.tensor(avg_factor, dtype=torch.float, device=device)).item()
+        # avg_factor 和 new_avg_factor 保持为设备上的0维张量，
+        # 避免 .item() 引入的 CPU-GPU 同步。torch.full 直接在设备上填充，
+        # 不经过 torch.tensor 的主机到设备拷贝
+        if not isinstance(avg_factor, Tensor):
+            avg_factor = torch.full((),
+                                    avg_factor,
+                                    dtype=torch.float,
+                                    device=device)
+        avg_factor = reduce_mean(avg_factor.float())
 
         # 计算分类和回归的损失
         losses_cls, losses_bbox, losses_dfl, \
@@ -197,45 +499,71 @@ class CrossKDGFL(CrossKDSingleStageDetector):
             self.bbox_head.prior_generator.strides,
             avg_factor=avg_factor)
 
-        new_avg_factor = sum(new_avg_factor)
-        new_avg_factor = reduce_mean(new_avg_factor).clamp_(min=1).item()
-        losses_bbox = list(map(lambda x: x / new_avg_factor, losses_bbox))
-        losses_dfl = list(map(lambda x: x / new_avg_factor, losses_dfl))
+        new_avg_factor = torch.stack(new_avg_factor).sum()
+        new_avg_factor = reduce_mean(new_avg_factor).clamp_(min=1)
+        # 各尺度级别的损失先堆叠求和再统一归一化，日志中的值与逐级相除后
+        # 求和一致
+        loss_bbox = torch.stack(losses_bbox).sum() / new_avg_factor
+        loss_dfl = torch.stack(losses_dfl).sum() / new_avg_factor
         losses = dict(
-            loss_cls=losses_cls, loss_bbox=losses_bbox, loss_dfl=losses_dfl)
+            loss_cls=losses_cls, loss_bbox=loss_bbox, loss_dfl=loss_dfl)
 
         # 计算分类和回归蒸馏的损失
-        losses_cls_kd, losses_reg_kd, kd_avg_factor = multi_apply(
-            self.pred_mimicking_loss_single,
+        loss_cls_kd, loss_reg_kd = self.pred_mimicking_loss(
             tea_cls_scores,
             tea_bbox_preds,
             reused_cls_scores,
             reused_bbox_preds,
             label_weights_list,
             avg_factor=avg_factor)
-        kd_avg_factor = sum(kd_avg_factor)
-        losses_reg_kd = list(map(lambda x: x / kd_avg_factor, losses_reg_kd))
-        losses.update(
-            dict(loss_cls_kd=losses_cls_kd, loss_reg_kd=losses_reg_kd))
+        losses.update(dict(loss_cls_kd=loss_cls_kd, loss_reg_kd=loss_reg_kd))
 
         # 如果使用了特征蒸馏，计算特征蒸馏的损失
         if self.with_feat_distill:
             losses_feat_kd = [
-                self.loss_feat_kd(feat, tea_feat)
+                self.loss_feat_kd(feat, tea_feat.float())
                 for feat, tea_feat in zip(feats, tea_feats)
             ]
             losses.update(loss_feat_kd=losses_feat_kd)
         return losses
 
-    def pred_mimicking_loss_single(self, tea_cls_score, tea_bbox_pred,
-                                   reused_cls_score, reused_bbox_pred,
-                                   label_weights, avg_factor):
+    def pred_mimicking_loss(self, tea_cls_scores, tea_bbox_preds,
+                            reused_cls_scores, reused_bbox_preds,
+                            label_weights_list, avg_factor):
+        """Calculate the prediction mimicking losses of all levels at once.
+
+        The predictions of all FPN levels are flattened and concatenated, so
+        each KD loss is computed by a single call instead of once per level.
+        Since both losses are sum-reduced before averaging, the result equals
+        the sum of the per-level losses.
+        """
+        # 教师预测只作为蒸馏目标，显式断开梯度，
+        # 避免在其 max、sigmoid 等运算上记录反向图
+        tea_cls_scores = [x.detach() for x in tea_cls_scores]
+        tea_bbox_preds = [x.detach() for x in tea_bbox_preds]
+
+        # 展平并拼接所有尺度级别的预测
+        cls_out_channels = self.bbox_head.cls_out_channels
+        reg_max = self.bbox_head.reg_max
+        tea_cls_score = torch.cat([
+            x.permute(0, 2, 3, 1).reshape(-1, cls_out_channels)
+            for x in tea_cls_scores
+        ]).float()
+        reused_cls_score = torch.cat([
+            x.permute(0, 2, 3, 1).reshape(-1, cls_out_channels)
+            for x in reused_cls_scores
+        ])
+        tea_bbox_pred = torch.cat([
+            x.permute(0, 2, 3, 1).reshape(-1, reg_max + 1)
+            for x in tea_bbox_preds
+        ])
+        reused_bbox_pred = torch.cat([
+            x.permute(0, 2, 3, 1).reshape(-1, reg_max + 1)
+            for x in reused_bbox_preds
+        ])
+        label_weights = torch.cat([x.reshape(-1) for x in label_weights_list])
+
         # 对教师模型和学生模型的分类预测进行蒸馏损失计算
-        tea_cls_score = tea_cls_score.permute(0, 2, 3, 1).reshape(
-            -1, self.bbox_head.cls_out_channels)
-        reused_cls_score = reused_cls_score.permute(0, 2, 3, 1).reshape(
-            -1, self.bbox_head.cls_out_channels)
-        label_weights = label_weights.reshape(-1)
         loss_cls_kd = self.loss_cls_kd(
             reused_cls_score,
             tea_cls_score,
@@ -243,17 +571,14 @@ class CrossKDGFL(CrossKDSingleStageDetector):
             avg_factor=avg_factor)
 
         # 对教师模型和学生模型的回归预测进行蒸馏损失计算
-        reg_max = self.bbox_head.reg_max
-        tea_bbox_pred = tea_bbox_pred.permute(0, 2, 3,
-                                              1).reshape(-1, reg_max + 1)
-        reused_bbox_pred = reused_bbox_pred.permute(0, 2, 3, 1).reshape(
-            -1, reg_max + 1)
-        reg_weights = tea_cls_score.max(dim=1)[0].sigmoid()
-        reg_weights[label_weights == 0] = 0
+        # 用乘以掩码代替布尔索引赋值，便于与 sigmoid 融合为逐元素运算
+        reg_weights = tea_cls_score.max(dim=1)[0].sigmoid() * (
+            label_weights != 0).to(tea_cls_score.dtype)
         loss_reg_kd = self.loss_reg_kd(
             reused_bbox_pred,
             tea_bbox_pred,
             weight=reg_weights[:, None].expand(-1, 4).reshape(-1),
             avg_factor=4.0)
+        loss_reg_kd = loss_reg_kd / reg_weights.sum()
 
-        return loss_cls_kd, loss_reg_kd, reg_weights.sum()
+        return loss_cls_kd, loss_reg_kd
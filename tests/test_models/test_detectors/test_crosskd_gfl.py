@@ -0,0 +1,343 @@
+# Copyright (c) OpenMMLab. All rights reserved.
+import copy
+from unittest import TestCase, skipIf
+
+import torch
+from mmengine.logging import MessageHub
+
+from mmdet import *  # noqa
+from mmdet.models.detectors.crosskd_gfl import _align_scale
+from mmdet.models.utils import unpack_gt_instances
+from mmdet.testing import demo_mm_inputs, get_detector_cfg
+from mmdet.utils import register_all_modules
+
+
+def _get_crosskd_gfl_cfg(**kd_kwargs):
+    """Build a CrossKDGFL config whose student and teacher are GFL-R18."""
+    model = get_detector_cfg('gfl/gfl_r18_fpn_1x_coco.py')
+    model.backbone.init_cfg = None
+    teacher = copy.deepcopy(model)
+    model.type = 'CrossKDGFL'
+    model.teacher_config = dict(model=teacher)
+    model.kd_cfg = dict(
+        loss_cls_kd=dict(type='KDQualityFocalLoss', beta=1, loss_weight=1.0),
+        loss_reg_kd=dict(
+            type='KnowledgeDistillationKLDivLoss',
+            class_reduction='sum',
+            T=1,
+            loss_weight=4.0),
+        reused_teacher_head_idx=3,
+        **kd_kwargs)
+    return model
+
+
+def _align_scale_baseline(stu_feat, tea_feat):
+    """The original permute/std formulation of ``align_scale``."""
+    N, C, H, W = stu_feat.size()
+    stu_feat = stu_feat.permute(1, 0, 2, 3).reshape(C, -1)
+    stu_mean = stu_feat.mean(dim=-1, keepdim=True)
+    stu_std = stu_feat.std(dim=-1, keepdim=True)
+    stu_feat = (stu_feat - stu_mean) / (stu_std + 1e-6)
+    tea_feat = tea_feat.permute(1, 0, 2, 3).reshape(C, -1)
+    tea_mean = tea_feat.mean(dim=-1, keepdim=True)
+    tea_std = tea_feat.std(dim=-1, keepdim=True)
+    stu_feat = stu_feat * tea_std + tea_mean
+    return stu_feat.reshape(C, N, H, W).permute(1, 0, 2, 3)
+
+
+def _forward_crosskd_single_baseline(detector, x, scale, module):
+    """The original per-conv loop of ``forward_crosskd_single``."""
+    idx = detector.reused_teacher_head_idx
+    cls_feat, reg_feat = x, x
+    cls_feat_hold, reg_feat_hold = x, x
+    for i, cls_conv in enumerate(module.cls_convs):
+        cls_feat = cls_conv(cls_feat, activate=False)
+        if i + 1 == idx:
+            cls_feat_hold = cls_feat
+        cls_feat = cls_conv.activate(cls_feat)
+    for i, reg_conv in enumerate(module.reg_convs):
+        reg_feat = reg_conv(reg_feat, activate=False)
+        if i + 1 == idx:
+            reg_feat_hold = reg_feat
+        reg_feat = reg_conv.activate(reg_feat)
+    cls_score = module.gfl_cls(cls_feat)
+    bbox_pred = scale(module.gfl_reg(reg_feat)).float()
+    return cls_score, bbox_pred, cls_feat_hold, reg_feat_hold
+
+
+def _pred_mimicking_loss_single_baseline(detector, tea_cls_score,
+                                         tea_bbox_pred, reused_cls_score,
+                                         reused_bbox_pred, label_weights,
+                                         avg_factor):
+    """The original per-level prediction mimicking loss."""
+    cls_out_channels = detector.bbox_head.cls_out_channels
+    reg_max = detector.bbox_head.reg_max
+    tea_cls_score = tea_cls_score.permute(0, 2, 3, 1).reshape(
+        -1, cls_out_channels)
+    reused_cls_score = reused_cls_score.permute(0, 2, 3, 1).reshape(
+        -1, cls_out_channels)
+    label_weights = label_weights.reshape(-1)
+    loss_cls_kd = detector.loss_cls_kd(
+        reused_cls_score, tea_cls_score, label_weights, avg_factor=avg_factor)
+    tea_bbox_pred = tea_bbox_pred.permute(0, 2, 3, 1).reshape(-1, reg_max + 1)
+    reused_bbox_pred = reused_bbox_pred.permute(0, 2, 3,
+                                                1).reshape(-1, reg_max + 1)
+    reg_weights = tea_cls_score.max(dim=1)[0].sigmoid()
+    reg_weights[label_weights == 0] = 0
+    loss_reg_kd = detector.loss_reg_kd(
+        reused_bbox_pred,
+        tea_bbox_pred,
+        weight=reg_weights[:, None].expand(-1, 4).reshape(-1),
+        avg_factor=4.0)
+    return loss_cls_kd, loss_reg_kd, reg_weights.sum()
+
+
+def _rand_head_feats(num_levels=5, num_imgs=2, channels=256, size=16):
+    return [
+        torch.randn(num_imgs, channels, size >> i, size >> i)
+        for i in range(num_levels)
+    ]
+
+
+class TestCrossKDGFL(TestCase):
+
+    def setUp(self):
+        register_all_modules()
+        self.message_hub = MessageHub.get_current_instance()
+        self._iter = self.message_hub.get_info('iter')
+
+    def tearDown(self):
+        if self._iter is None:
+            self.message_hub.runtime_info.pop('iter', None)
+        else:
+            self.message_hub.update_info('iter', self._iter)
+
+    def test_align_cache(self):
+        from mmdet.registry import MODELS
+        detector = MODELS.build(
+            _get_crosskd_gfl_cfg(
+                align_cache_cfg=dict(thr=1e-3, start_iter=10, interval=1)))
+        tea_cls, tea_reg = _rand_head_feats(), _rand_head_feats()
+        stu_cls, stu_reg = _rand_head_feats(), _rand_head_feats()
+        message_hub = self.message_hub
+
+        # before start_iter the cache is neither used nor filled
+        message_hub.update_info('iter', 0)
+        detector.reuse_teacher_head_levels(tea_cls, tea_reg, stu_cls,
+                                           stu_reg)
+        self.assertIsNone(detector._align_cache_hit)
+        self.assertEqual(len(detector._align_stats_cache), 0)
+
+        # the first iteration after start_iter fills the cache and runs
+        # the default path
+        message_hub.update_info('iter', 10)
+        detector.reuse_teacher_head_levels(tea_cls, tea_reg, stu_cls,
+                                           stu_reg)
+        self.assertFalse(detector._align_cache_hit)
+        self.assertEqual(len(detector._align_stats_cache), 10)
+
+        # unchanged student features hit the cache with the same result
+        message_hub.update_info('iter', 11)
+        detector.reuse_teacher_head_levels(tea_cls, tea_reg, stu_cls,
+                                           stu_reg)
+        self.assertTrue(detector._align_cache_hit)
+        for level in range(len(stu_cls)):
+            self.assertTrue(
+                torch.allclose(
+                    detector.align_scale(
+                        stu_cls[level],
+                        tea_cls[level],
+                        cache_key=(level, 'cls')),
+                    _align_scale(stu_cls[level], tea_cls[level]),
+                    atol=1e-4))
+        # the teacher statistics are not cached
+        tea_feat = tea_cls[0] * 2 + 1
+        self.assertTrue(
+            torch.allclose(
+                detector.align_scale(
+                    stu_cls[0], tea_feat, cache_key=(0, 'cls')),
+                _align_scale(stu_cls[0], tea_feat),
+                atol=1e-4))
+
+        # shifted student features miss the cache and refresh it
+        message_hub.update_info('iter', 12)
+        stu_cls = [feat + 1 for feat in stu_cls]
+        detector.reuse_teacher_head_levels(tea_cls, tea_reg, stu_cls,
+                                           stu_reg)
+        self.assertFalse(detector._align_cache_hit)
+        self.assertTrue(detector._align_cache_refresh)
+
+    def test_forward_train(self):
+        from mmdet.registry import MODELS
+        detector = MODELS.build(_get_crosskd_gfl_cfg())
+        packed_inputs = demo_mm_inputs(
+            2, [[3, 128, 128], [3, 125, 130]], num_classes=1)
+        data = detector.data_preprocessor(packed_inputs, True)
+        losses = detector.forward(**data, mode='loss')
+        self.assertIsInstance(losses, dict)
+        for name in ('loss_cls', 'loss_bbox', 'loss_dfl', 'loss_cls_kd',
+                     'loss_reg_kd'):
+            self.assertIn(name, losses)
+
+    @skipIf(not hasattr(torch, 'compile'), 'requires PyTorch >= 2.0')
+    def test_compile_cfg(self):
+        from mmdet.registry import MODELS
+        detector = MODELS.build(
+            _get_crosskd_gfl_cfg(compile_cfg=dict(backend='eager')))
+        packed_inputs = demo_mm_inputs(
+            2, [[3, 128, 128], [3, 125, 130]], num_classes=1)
+        data = detector.data_preprocessor(packed_inputs, True)
+        losses = detector.forward(**data, mode='loss')
+        self.assertIsInstance(losses, dict)
+        self.assertIn('loss_cls_kd', losses)
+
+        # reuse_teacher_head writes the align cache, so it is not compiled
+        detector = MODELS.build(
+            _get_crosskd_gfl_cfg(
+                compile_cfg=dict(backend='eager'),
+                align_cache_cfg=dict(start_iter=10)))
+        self.assertTrue(hasattr(detector.reuse_teacher_head, '__func__'))
+
+    def test_forward_crosskd_single(self):
+        from mmdet.registry import MODELS
+        detector = MODELS.build(_get_crosskd_gfl_cfg())
+        module = detector.bbox_head
+        scale = module.scales[0]
+        x = torch.randn(2, 256, 16, 16)
+        for idx in (0, 1, 3, module.stacked_convs):
+            detector.reused_teacher_head_idx = idx
+            with torch.no_grad():
+                outs = detector.forward_crosskd_single(x, scale, module)
+                expected = _forward_crosskd_single_baseline(
+                    detector, x, scale, module)
+            for out, exp in zip(outs, expected):
+                self.assertTrue(torch.allclose(out, exp))
+
+    def test_align_scale(self):
+        stu_feat = torch.randn(2, 256, 8, 8) * 3 + 1
+        tea_feat = torch.randn(2, 256, 8, 8) * 0.5 - 2
+        self.assertTrue(
+            torch.allclose(
+                _align_scale(stu_feat, tea_feat),
+                _align_scale_baseline(stu_feat, tea_feat),
+                rtol=1e-4,
+                atol=1e-4))
+
+        # a single value per channel falls back to the teacher mean
+        stu_feat = torch.randn(1, 256, 1, 1)
+        tea_feat = torch.randn(1, 256, 1, 1)
+        self.assertTrue(
+            torch.allclose(_align_scale(stu_feat, tea_feat), tea_feat))
+
+    def test_pred_mimicking_loss(self):
+        from mmdet.registry import MODELS
+        detector = MODELS.build(_get_crosskd_gfl_cfg())
+        cls_out_channels = detector.bbox_head.cls_out_channels
+        reg_channels = 4 * (detector.bbox_head.reg_max + 1)
+        tea_cls_scores = _rand_head_feats(channels=cls_out_channels)
+        reused_cls_scores = _rand_head_feats(channels=cls_out_channels)
+        tea_bbox_preds = _rand_head_feats(channels=reg_channels)
+        reused_bbox_preds = _rand_head_feats(channels=reg_channels)
+        label_weights_list = [
+            (torch.rand(x.size(0), x.size(2) * x.size(3)) > 0.3).float()
+            for x in tea_cls_scores
+        ]
+        avg_factor = torch.tensor(7.)
+
+        loss_cls_kd, loss_reg_kd = detector.pred_mimicking_loss(
+            tea_cls_scores, tea_bbox_preds, reused_cls_scores,
+            reused_bbox_preds, label_weights_list, avg_factor)
+
+        losses_cls_kd, losses_reg_kd, kd_avg_factors = [], [], []
+        for level in range(len(tea_cls_scores)):
+            cls_kd, reg_kd, kd_avg_factor = \
+                _pred_mimicking_loss_single_baseline(
+                    detector, tea_cls_scores[level], tea_bbox_preds[level],
+                    reused_cls_scores[level], reused_bbox_preds[level],
+                    label_weights_list[level], avg_factor)
+            losses_cls_kd.append(cls_kd)
+            losses_reg_kd.append(reg_kd)
+            kd_avg_factors.append(kd_avg_factor)
+        kd_avg_factor = sum(kd_avg_factors)
+        self.assertTrue(torch.allclose(loss_cls_kd, sum(losses_cls_kd)))
+        self.assertTrue(
+            torch.allclose(loss_reg_kd,
+                           sum(x / kd_avg_factor for x in losses_reg_kd)))
+
+    def test_loss_by_feat(self):
+        from mmdet.registry import MODELS
+        detector = MODELS.build(_get_crosskd_gfl_cfg())
+        packed_inputs = demo_mm_inputs(
+            2, [[3, 128, 128], [3, 128, 128]], num_classes=1)
+        data = detector.data_preprocessor(packed_inputs, True)
+        batch_gt_instances, batch_gt_instances_ignore, batch_img_metas = \
+            unpack_gt_instances(data['data_samples'])
+        cls_out_channels = detector.bbox_head.cls_out_channels
+        reg_channels = 4 * (detector.bbox_head.reg_max + 1)
+        cls_scores = _rand_head_feats(channels=cls_out_channels)
+        bbox_preds = _rand_head_feats(channels=reg_channels)
+        feats = _rand_head_feats()
+
+        losses = detector.loss_by_feat(
+            _rand_head_feats(channels=cls_out_channels),
+            _rand_head_feats(channels=reg_channels), feats, cls_scores,
+            bbox_preds, feats, _rand_head_feats(channels=cls_out_channels),
+            _rand_head_feats(channels=reg_channels), batch_gt_instances,
+            batch_img_metas, batch_gt_instances_ignore)
+        # GFLHead.loss_by_feat divides each level by the avg factor and
+        # returns per-level lists
+        head_losses = detector.bbox_head.loss_by_feat(
+            cls_scores, bbox_preds, batch_gt_instances, batch_img_metas,
+            batch_gt_instances_ignore)
+        for name in ('loss_cls', 'loss_bbox', 'loss_dfl'):
+            loss = losses[name]
+            if isinstance(loss, list):
+                loss = sum(loss)
+            self.assertTrue(torch.allclose(loss, sum(head_losses[name])))
+
+    def test_get_cached_anchors(self):
+        from mmdet.registry import MODELS
+        detector = MODELS.build(_get_crosskd_gfl_cfg())
+        packed_inputs = demo_mm_inputs(
+            2, [[3, 128, 128], [3, 96, 128]], num_classes=1)
+        data = detector.data_preprocessor(packed_inputs, True)
+        batch_gt_instances, batch_gt_instances_ignore, batch_img_metas = \
+            unpack_gt_instances(data['data_samples'])
+        featmap_sizes = [x.shape[-2:] for x in _rand_head_feats()]
+        num_levels = len(featmap_sizes)
+
+        anchor_list, valid_flag_list = detector.get_cached_anchors(
+            featmap_sizes, batch_img_metas, device='cpu')
+        self.assertEqual(len(detector._anchor_cache), 1)
+        cached_anchors = next(iter(detector._anchor_cache.values()))
+        cached_shapes = [anchors.shape for anchors in cached_anchors]
+        ref_anchor_list, ref_valid_flag_list = detector.bbox_head.get_anchors(
+            featmap_sizes, batch_img_metas, device='cpu')
+        for img_id in range(len(batch_img_metas)):
+            for level in range(num_levels):
+                self.assertTrue(
+                    torch.equal(anchor_list[img_id][level],
+                                ref_anchor_list[img_id][level]))
+                self.assertTrue(
+                    torch.equal(valid_flag_list[img_id][level],
+                                ref_valid_flag_list[img_id][level]))
+
+        # get_targets replaces the items of the returned lists in place,
+        # which must not leak into the cache
+        detector.bbox_head.get_targets(
+            anchor_list,
+            valid_flag_list,
+            batch_gt_instances,
+            batch_img_metas,
+            batch_gt_instances_ignore=batch_gt_instances_ignore)
+        self.assertEqual(len(cached_anchors), num_levels)
+        self.assertEqual([anchors.shape for anchors in cached_anchors],
+                         cached_shapes)
+
+        # a second call with the same feature map sizes reuses the anchors
+        anchor_list, _ = detector.get_cached_anchors(
+            featmap_sizes, batch_img_metas, device='cpu')
+        self.assertEqual(len(detector._anchor_cache), 1)
+        for anchors in anchor_list:
+            for level in range(num_levels):
+                self.assertIs(anchors[level], cached_anchors[level])